@@ -1,14 +1,19 @@
 import streamlit as st
 import base64
 import bcrypt
-from pymongo import MongoClient
-from datetime import datetime, time
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, time, timedelta
 import pandas as pd
 import plotly.express as px
 from bson import ObjectId
+from bson.errors import InvalidId
 import socket
 import gridfs
 import re
+import threading
+from collections import OrderedDict
+from time import monotonic, sleep
 def rerun():
     st.rerun()
 def dedupe_courses(default_list, db_list):
@@ -34,8 +39,452 @@ books_col = db["books"]
 users_col = db["users"]
 logs_col = db["logs"]
 fav_col = db["favorites"]
+meta_col = db["meta"]
 fs = gridfs.GridFS(db)
 
+# --- Search Result Cache ---
+SEARCH_PAGE_SIZE = 50
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 300  # seconds
+
+class SearchCache:
+    """Process-wide LRU + TTL cache of search results, keyed by catalog version."""
+
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return list(value)
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, list(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+@st.cache_resource
+def get_search_cache():
+    return SearchCache()
+
+def get_catalog_version():
+    doc = meta_col.find_one({"_id": "catalog"}, {"version": 1})
+    return doc.get("version", 0) if doc else 0
+
+def bump_catalog_version():
+    """Invalidate cached search results after any change to books_col."""
+    meta_col.update_one({"_id": "catalog"}, {"$inc": {"version": 1}}, upsert=True)
+    get_search_cache().clear()
+
+# --- Popularity Index ---
+popular_col = db["popularity"]
+POPULARITY_HALF_LIFE_DAYS = 7
+POPULARITY_EPOCH = datetime(2024, 1, 1)
+POPULARITY_REBASE_DAYS = 20 * POPULARITY_HALF_LIFE_DAYS  # keeps weights below ~2^20
+POPULARITY_BATCH = 500
+POPULARITY_REFRESH_INTERVAL = 60  # seconds between catch-up runs
+POPULARITY_SETTLE = timedelta(seconds=5)  # let concurrent log inserts commit before passing them
+POPULARITY_LEASE = timedelta(minutes=2)  # only the lease holder refreshes, across all processes
+
+@st.cache_resource
+def ensure_popularity_indexes():
+    books_col.create_index([("popularity", -1), ("uploaded_at", -1)])
+    books_col.create_index([("course", 1), ("popularity", -1), ("uploaded_at", -1)])
+    popular_col.create_index([("kind", 1), ("score", -1)])
+    return True
+
+def popularity_course(book):
+    return book.get("course") or "Other / Not Mapped"
+
+def popularity_weight(ts, epoch):
+    """Weight of a download made at ``ts``, relative to ``epoch``.
+
+    Weights grow by 2x every half-life, so ordering by the stored sum is the
+    same as ordering by the decayed score. To keep the numbers bounded the
+    epoch is moved forward every POPULARITY_REBASE_DAYS and stored scores are
+    scaled down by the same factor, which preserves the ordering.
+    """
+    days = (ts - epoch).total_seconds() / 86400
+    return 2 ** (days / POPULARITY_HALF_LIFE_DAYS)
+
+def acquire_popularity_lease(owner):
+    """Take or renew the refresher lease; False if another process holds it."""
+    now = datetime.utcnow()
+    try:
+        meta_col.update_one(
+            {"_id": "popularity_lease", "$or": [{"owner": owner}, {"expires": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires": now + POPULARITY_LEASE}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+def finish_popularity_rebase(state):
+    """Apply a pending epoch move, then record the new epoch.
+
+    Each rescaled document is stamped with the target epoch, so re-running
+    after a partial failure never scales a score twice.
+    """
+    pending = state.get("pending_rebase")
+    if not pending:
+        return state
+    factor = popularity_weight(pending["from"], pending["to"])
+    books_col.update_many(
+        {"popularity": {"$gt": 0}, "popularity_epoch": {"$ne": pending["to"]}},
+        {"$mul": {"popularity": factor}, "$set": {"popularity_epoch": pending["to"]}}
+    )
+    popular_col.update_many(
+        {"kind": "course", "epoch": {"$ne": pending["to"]}},
+        {"$mul": {"score": factor}, "$set": {"epoch": pending["to"]}}
+    )
+    meta_col.update_one(
+        {"_id": "popularity", "pending_rebase.to": pending["to"]},
+        {"$set": {"epoch": pending["to"]}, "$unset": {"pending_rebase": ""}}
+    )
+    return meta_col.find_one({"_id": "popularity"}) or {}
+
+def refresh_popularity(limit=POPULARITY_BATCH):
+    """Fold download logs newer than the stored watermark into book and course scores.
+
+    Book scores live on the book document (``popularity``) so the Popular
+    sort can combine them with any search filter; course totals live in
+    popular_col. Callers must hold the refresher lease.
+    """
+    ensure_popularity_indexes()
+    state = meta_col.find_one({"_id": "popularity"}) or {}
+
+    # Rescale before counting anything, so no increment uses an epoch the stored scores aren't on
+    epoch = state.get("epoch", POPULARITY_EPOCH)
+    if not state.get("pending_rebase") and datetime.utcnow() - epoch > timedelta(days=POPULARITY_REBASE_DAYS):
+        try:
+            meta_col.update_one(
+                {"_id": "popularity", "pending_rebase": {"$exists": False}},
+                {"$set": {"pending_rebase": {"from": epoch, "to": datetime.utcnow()}}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass
+        state = meta_col.find_one({"_id": "popularity"}) or {}
+    state = finish_popularity_rebase(state)
+    epoch = state.get("epoch", POPULARITY_EPOCH)
+
+    last_id = state.get("last_log_id")
+    # ObjectIds are made client-side and can commit out of order, so only read
+    # logs old enough that nothing earlier can still be in flight
+    log_query = {"type": "download", "timestamp": {"$lt": datetime.utcnow() - POPULARITY_SETTLE}}
+    if last_id:
+        log_query["_id"] = {"$gt": last_id}
+    logs = list(logs_col.find(log_query, {"book": 1, "book_id": 1, "timestamp": 1}).sort("_id", 1).limit(limit))
+    if not logs:
+        if not state.get("caught_up"):
+            try:
+                meta_col.update_one({"_id": "popularity", "last_log_id": last_id}, {"$set": {"caught_up": True}}, upsert=True)
+            except DuplicateKeyError:
+                pass  # another refresher moved the watermark meanwhile
+        return 0
+
+    # Claim the batch first so concurrent refreshers never count the same logs twice
+    try:
+        meta_col.update_one(
+            {"_id": "popularity", "last_log_id": last_id, "epoch": epoch, "pending_rebase": {"$exists": False}},
+            {"$set": {"last_log_id": logs[-1]["_id"], "caught_up": len(logs) < limit}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return 0
+
+    # Older logs only carry the title, newer ones also carry book_id
+    ids = [l["book_id"] for l in logs if l.get("book_id")]
+    titles = [l["book"] for l in logs if not l.get("book_id") and l.get("book")]
+    lookup = {}
+    for b in books_col.find({"$or": [{"_id": {"$in": ids}}, {"title": {"$in": titles}}]}, {"title": 1, "course": 1}):
+        lookup[b["_id"]] = b
+        lookup.setdefault(b["title"], b)
+
+    book_scores, course_scores = {}, {}
+    for l in logs:
+        book = lookup.get(l.get("book_id")) or lookup.get(l.get("book"))
+        if not book or not isinstance(l.get("timestamp"), datetime):
+            continue
+        weight = popularity_weight(l["timestamp"], epoch)
+        book_scores[book["_id"]] = book_scores.get(book["_id"], 0) + weight
+        course = popularity_course(book)
+        course_scores[course] = course_scores.get(course, 0) + weight
+
+    now = datetime.utcnow()
+    if book_scores:
+        books_col.bulk_write([
+            UpdateOne({"_id": book_id}, {"$inc": {"popularity": score}})
+            for book_id, score in book_scores.items()
+        ], ordered=False)
+    if course_scores:
+        popular_col.bulk_write([
+            UpdateOne({"_id": f"course:{course}"}, {
+                "$inc": {"score": score},
+                "$set": {"kind": "course", "course": course, "updated_at": now}
+            }, upsert=True)
+            for course, score in course_scores.items()
+        ], ordered=False)
+    return len(logs)
+
+def is_popularity_ready():
+    """True once the index has folded in the whole download log backlog."""
+    state = meta_col.find_one({"_id": "popularity"}, {"caught_up": 1})
+    return bool(state and state.get("caught_up"))
+
+@st.cache_resource
+def start_popularity_refresher():
+    """Keep the popularity index caught up on a daemon thread, off the page-render path."""
+    runner = {"error": None}
+    owner = str(ObjectId())
+
+    def run():
+        while True:
+            try:
+                while acquire_popularity_lease(owner) and refresh_popularity() >= POPULARITY_BATCH:
+                    pass
+                runner["error"] = None
+            except Exception as e:
+                runner["error"] = f"{datetime.utcnow():%Y-%m-%d %H:%M} UTC: {e}"
+            sleep(POPULARITY_REFRESH_INTERVAL)
+
+    runner["thread"] = threading.Thread(target=run, daemon=True)
+    runner["thread"].start()
+    return runner
+
+def move_course_popularity(book, new_course=None):
+    """Take a book's score off its course total, and add it to ``new_course`` if given."""
+    score = book.get("popularity", 0)
+    if not score:
+        return
+    ops = [UpdateOne({"_id": f"course:{popularity_course(book)}"}, {"$inc": {"score": -score}})]
+    if new_course:
+        ops.append(UpdateOne({"_id": f"course:{new_course}"}, {
+            "$inc": {"score": score},
+            "$set": {"kind": "course", "course": new_course, "updated_at": datetime.utcnow()}
+        }, upsert=True))
+    popular_col.bulk_write(ops, ordered=True)
+
+def get_popular_books(query=None, skip=0, limit=SEARCH_PAGE_SIZE):
+    """Books matching ``query`` ordered by decayed download score, newest first on ties."""
+    return list(books_col.find(query or {}).sort([("popularity", -1), ("uploaded_at", -1)]).skip(skip).limit(limit))
+
+def get_popular_courses(limit=5):
+    return list(popular_col.find({"kind": "course"}).sort("score", -1).limit(limit))
+
+# --- GridFS Consistency Sweeper ---
+files_col = db["fs.files"]
+chunks_col = db["fs.chunks"]
+SWEEP_PHASES = ["files", "chunks", "books"]
+SWEEP_BATCH_SIZE = 200
+SWEEP_GRACE = timedelta(hours=1)  # leave room for uploads that haven't inserted their book yet
+SWEEP_MAX_FINDINGS = 100
+
+@st.cache_resource
+def ensure_sweep_indexes():
+    books_col.create_index("file_id")
+    chunks_col.create_index([("files_id", 1), ("n", 1)], unique=True)
+    return True
+
+def get_sweep_state():
+    return meta_col.find_one({"_id": "gridfs_sweep"}) or {"phase": "files", "cursor": None, "passes": 0}
+
+def reset_sweep_state():
+    meta_col.delete_one({"_id": "gridfs_sweep"})
+
+def as_object_id(value):
+    if isinstance(value, ObjectId):
+        return value
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+def sweep_files(cursor, batch_size, cutoff):
+    """Find fs.files entries no book points to, or whose chunk set is incomplete."""
+    query = {"_id": {"$gt": cursor}} if cursor else {}
+    files = list(files_col.find(query, {"length": 1, "chunkSize": 1, "uploadDate": 1, "filename": 1}).sort("_id", 1).limit(batch_size))
+    if not files:
+        return None, []
+    ids = [f["_id"] for f in files]
+
+    # file_id is stored as an ObjectId by uploads but may be a string on older rows
+    referenced = {str(b["file_id"]) for b in books_col.find({"file_id": {"$in": ids + [str(i) for i in ids]}}, {"file_id": 1})}
+    chunk_counts = {r["_id"]: r["count"] for r in chunks_col.aggregate([
+        {"$match": {"files_id": {"$in": ids}}},
+        {"$group": {"_id": "$files_id", "count": {"$sum": 1}}}
+    ])}
+
+    findings = []
+    for f in files:
+        chunk_size = f.get("chunkSize") or 1
+        expected = -(-f.get("length", 0) // chunk_size)
+        actual = chunk_counts.get(f["_id"], 0)
+        if actual != expected:
+            findings.append({"kind": "partial_chunks", "id": f["_id"],
+                             "detail": f"{f.get('filename')}: {actual}/{expected} chunks"})
+        elif str(f["_id"]) not in referenced and f.get("uploadDate", cutoff) < cutoff:
+            findings.append({"kind": "orphan_file", "id": f["_id"],
+                             "detail": f"{f.get('filename')} ({f.get('length', 0)} bytes)"})
+    return ids[-1], findings
+
+def sweep_chunks(cursor, batch_size, cutoff):
+    """Find chunk sets whose fs.files entry is missing."""
+    query = {"files_id": {"$gt": cursor}} if cursor else {}
+    rows = chunks_col.find(query, {"files_id": 1, "_id": 0}).sort("files_id", 1).limit(batch_size)
+    files_ids = list(dict.fromkeys(r["files_id"] for r in rows))
+    if not files_ids:
+        return None, []
+
+    existing = {f["_id"] for f in files_col.find({"_id": {"$in": files_ids}}, {"_id": 1})}
+    findings = []
+    for files_id in files_ids:
+        if files_id in existing:
+            continue
+        # GridFS writes chunks before the files entry, so skip uploads still in flight
+        if isinstance(files_id, ObjectId) and files_id.generation_time.replace(tzinfo=None) >= cutoff:
+            continue
+        findings.append({"kind": "orphan_chunks", "id": files_id, "detail": "chunks without fs.files entry"})
+    return files_ids[-1], findings
+
+def sweep_books(cursor, batch_size, cutoff):
+    """Find books whose file_id points at a missing GridFS file."""
+    query = {"file_id": {"$nin": ["", None]}}
+    if cursor:
+        query["_id"] = {"$gt": cursor}
+    books = list(books_col.find(query, {"title": 1, "file_id": 1}).sort("_id", 1).limit(batch_size))
+    if not books:
+        return None, []
+
+    file_ids = [oid for oid in (as_object_id(b["file_id"]) for b in books) if oid]
+    existing = {f["_id"] for f in files_col.find({"_id": {"$in": file_ids}}, {"_id": 1})}
+    findings = [
+        {"kind": "dangling_reference", "id": b["_id"], "detail": f"{b.get('title')} -> {b['file_id']}"}
+        for b in books if as_object_id(b["file_id"]) not in existing
+    ]
+    return books[-1]["_id"], findings
+
+SWEEPERS = {"files": sweep_files, "chunks": sweep_chunks, "books": sweep_books}
+
+def reclaim(finding):
+    """Repair one finding; returns True if any book record was changed."""
+    if finding["kind"] == "orphan_file":
+        fs.delete(finding["id"])
+    elif finding["kind"] == "partial_chunks":
+        # The blob is unreadable; drop it and detach any book still pointing at it
+        fs.delete(finding["id"])
+        result = books_col.update_many({"file_id": {"$in": [finding["id"], str(finding["id"])]}}, {"$unset": {"file_id": ""}})
+        return result.modified_count > 0
+    elif finding["kind"] == "orphan_chunks":
+        chunks_col.delete_many({"files_id": finding["id"]})
+    elif finding["kind"] == "dangling_reference":
+        books_col.update_one({"_id": finding["id"]}, {"$unset": {"file_id": ""}})
+        return True
+    return False
+
+def run_sweep_batch(dry_run=True, batch_size=SWEEP_BATCH_SIZE):
+    """Check one bounded batch of the current phase and advance the stored cursor.
+
+    State lives in meta_col, so a sweep can be stopped and resumed at any
+    point; each full pass walks fs.files, fs.chunks and then books_col.
+    """
+    ensure_sweep_indexes()
+    state = get_sweep_state()
+    phase = state.get("phase", "files")
+    cursor = state.get("cursor")
+    next_cursor, findings = SWEEPERS[phase](cursor, batch_size, datetime.utcnow() - SWEEP_GRACE)
+
+    counts = {}
+    for finding in findings:
+        counts[finding["kind"]] = counts.get(finding["kind"], 0) + 1
+
+    # Stats cover the pass in progress; a finished pass moves them to last_stats
+    update = {"$set": {"updated_at": datetime.utcnow()}}
+    if next_cursor is not None or phase != SWEEP_PHASES[-1]:
+        if next_cursor is not None:
+            update["$set"].update({"phase": phase, "cursor": next_cursor})
+        else:
+            update["$set"].update({"phase": SWEEP_PHASES[SWEEP_PHASES.index(phase) + 1], "cursor": None})
+        if counts:
+            update["$inc"] = {f"stats.{kind}": n for kind, n in counts.items()}
+    else:
+        last_stats = dict(state.get("stats", {}))
+        for kind, n in counts.items():
+            last_stats[kind] = last_stats.get(kind, 0) + n
+        update["$set"].update({"phase": SWEEP_PHASES[0], "cursor": None, "completed_at": datetime.utcnow(),
+                               "last_stats": last_stats})
+        update["$unset"] = {"stats": ""}
+        update["$inc"] = {"passes": 1}
+
+    # Claim the batch so a concurrent sweeper doesn't report or reclaim it twice
+    try:
+        meta_col.update_one({"_id": "gridfs_sweep", "phase": phase, "cursor": cursor}, update, upsert=True)
+    except DuplicateKeyError:
+        return get_sweep_state()
+
+    records = []
+    catalog_changed = False
+    for finding in findings:
+        reclaimed, error = False, None
+        if not dry_run:
+            try:
+                catalog_changed = reclaim(finding) or catalog_changed
+                reclaimed = True
+            except Exception as e:
+                error = str(e)
+        records.append({"kind": finding["kind"], "id": str(finding["id"]), "detail": finding["detail"],
+                        "reclaimed": reclaimed, "error": error, "at": datetime.utcnow()})
+
+    if records:
+        meta_col.update_one({"_id": "gridfs_sweep"}, {
+            "$push": {"findings": {"$each": records, "$slice": -SWEEP_MAX_FINDINGS}}
+        })
+    if catalog_changed:
+        bump_catalog_version()
+    return get_sweep_state()
+
+@st.cache_resource
+def get_sweeper_runner():
+    return {"thread": None, "stop": None, "error": None}
+
+def start_background_sweep(dry_run=True, batch_size=SWEEP_BATCH_SIZE, pause=1.0):
+    """Run batches on a daemon thread until one full pass completes or it is stopped."""
+    runner = get_sweeper_runner()
+    if runner["thread"] and runner["thread"].is_alive():
+        return False
+    stop = threading.Event()
+
+    def run():
+        target = get_sweep_state().get("passes", 0) + 1
+        try:
+            while not stop.is_set():
+                if run_sweep_batch(dry_run, batch_size).get("passes", 0) >= target:
+                    break
+                stop.wait(pause)
+        except Exception as e:
+            runner["error"] = str(e)
+
+    runner.update({"thread": threading.Thread(target=run, daemon=True), "stop": stop, "error": None})
+    runner["thread"].start()
+    return True
+
 # --- Utility Functions ---
 def get_ip():
     try:
@@ -125,6 +574,7 @@ def upload_book():
                 "file_name": uploaded_file.name,
                 "uploaded_at": datetime.utcnow()
             })
+            bump_catalog_version()
             st.success("Book uploaded")
 
 # --- Admin Dashboard ---
@@ -142,6 +592,12 @@ def admin_dashboard():
     st.metric("Total Activity", total_views)
     st.metric("Unique Downloads", total_downloads)
 
+    refresher = start_popularity_refresher()
+    if refresher["error"]:
+        st.error(f"❌ Popularity index refresh failed: {refresher['error']}")
+    elif not is_popularity_ready():
+        st.info("⏳ Popularity index is still catching up on the download log.")
+
     logs = list(logs_col.find().sort("timestamp", -1))
     if logs:
         df = pd.DataFrame(logs)
@@ -237,35 +693,62 @@ def search_books():
 
             course_filter = st.selectbox("Course", ["All"] + all_courses, key="public_search_course")
             language_filter = st.selectbox("Language", ["All"] + sorted(languages), key="public_search_language")
+            page = st.number_input("Page", min_value=1, value=1, step=1, key="public_search_page")
+            sort_order = st.selectbox("Sort by", ["Newest", "Popular"], key="public_search_sort")
 
         submitted = st.form_submit_button("🔍 Search")
 
+    title = title.strip()
+    author = author.strip()
+    keywords = sorted({k.strip().lower() for k in keyword_input.split(",") if k.strip()})
+
     query = {}
-    filters_applied = False
 
     if title:
         query["title"] = {"$regex": title, "$options": "i"}
-        filters_applied = True
     if author:
         query["author"] = {"$regex": author, "$options": "i"}
-        filters_applied = True
-    if keyword_input:
-        keywords = [k.strip().lower() for k in keyword_input.split(",") if k.strip()]
+    if keywords:
         query["keywords"] = {"$in": keywords}
-        filters_applied = True
     if language_filter != "All":
         query["language"] = language_filter
-        filters_applied = True
     if course_filter != "All":
         query["course"] = course_filter
-        filters_applied = True
 
     books = []
+    cache = get_search_cache()
+    refresher = start_popularity_refresher()
     if submitted:
-        if filters_applied:
-            books = list(books_col.find(query).sort("uploaded_at", -1).limit(50))
-        else:
-            books = list(books_col.find().sort("uploaded_at", -1).limit(50))
+        skip = (int(page) - 1) * SEARCH_PAGE_SIZE
+        cache_key = (get_catalog_version(), title.lower(), author.lower(), tuple(keywords), course_filter, language_filter, skip, sort_order)
+        books = cache.get(cache_key)
+        if books is None:
+            if sort_order == "Popular":
+                books = get_popular_books(query=query, skip=skip)
+                if is_popularity_ready():
+                    cache.put(cache_key, books)
+                elif refresher["error"]:
+                    st.warning("⚠️ Popularity rankings are temporarily unavailable; results may be out of order.")
+                else:
+                    st.info("⏳ Popularity rankings are still being built from past downloads; order may change.")
+            else:
+                books = list(books_col.find(query).sort("uploaded_at", -1).skip(skip).limit(SEARCH_PAGE_SIZE))
+                cache.put(cache_key, books)
+    else:
+        landing_key = (get_catalog_version(), "popular_landing")
+        landing = cache.get(landing_key)
+        if landing is None:
+            landing = [[], []]
+            if is_popularity_ready():
+                landing = [get_popular_books(query={"popularity": {"$gt": 0}}, limit=10), get_popular_courses()]
+                cache.put(landing_key, landing)
+        popular_books, popular_courses = landing
+        if popular_books:
+            st.write("### 🔥 Popular Books")
+            for book in popular_books:
+                st.write(f"- **{book['title']}** by {book.get('author') or 'N/A'} ({book.get('course', 'Not tagged')})")
+        if popular_courses:
+            st.write("**Trending courses:** " + ", ".join(c["course"] for c in popular_courses))
 
     ip = get_ip()
     today_start = datetime.combine(datetime.utcnow().date(), time.min)
@@ -323,6 +806,7 @@ def search_books():
                             "user": current_user.lower() if current_user else "guest",
                             "ip": ip,
                             "book": book["title"],
+                            "book_id": book["_id"],
                             "author": book.get("author"),
                             "language": book.get("language"),
                             "timestamp": datetime.utcnow()
@@ -368,6 +852,8 @@ def delete_book():
             books_col.delete_one({"_id": book["_id"]})
             logs_col.delete_many({"book": book["title"]})
             fav_col.delete_many({"book_id": str(book["_id"])})
+            move_course_popularity(book)
+            bump_catalog_version()
 
             st.success("✅ Book deleted successfully.")
             del st.session_state[key]
@@ -484,6 +970,9 @@ def edit_book_metadata():
                 "course": course
             }}
         )
+        if course != popularity_course(book):
+            move_course_popularity(book, course)
+        bump_catalog_version()
         st.success("✅ Book metadata updated!")
 
 def add_new_course():
@@ -510,6 +999,7 @@ def add_new_course():
                 "file_id": "",
                 "uploaded_at": datetime.utcnow()
             })
+            bump_catalog_version()
             st.success(f"Course '{new_course}' added!")
 def delete_course():
     st.subheader("🗑️ Delete Course")
@@ -536,6 +1026,8 @@ def delete_course():
                 fav_col.delete_many({"book_id": str(book["_id"])})
                 deleted += 1
 
+            popular_col.delete_one({"_id": f"course:{course}"})
+            bump_catalog_version()
             st.success(f"✅ Deleted course '{course}' and {deleted} book(s).")
             rerun()
 def bulk_upload_with_gridfs():
@@ -585,12 +1077,6 @@ def bulk_upload_with_gridfs():
             st.warning(f"⚠️ Skipping '{row.get('title', 'Unknown')}' - No matching PDF file found.")
             continue
 
-        try:
-            file_id = fs.put(file_data, filename=file_name)
-        except Exception as e:
-            st.error(f"❌ Failed to upload '{file_name}': {e}")
-            continue
-
         existing = books_col.find_one({
             "title": row.get("title", ""),
             "file_name": file_name
@@ -600,6 +1086,12 @@ def bulk_upload_with_gridfs():
             st.warning(f"⚠️ Skipping duplicate: '{row.get('title')}' already exists.")
             continue
 
+        try:
+            file_id = fs.put(file_data, filename=file_name)
+        except Exception as e:
+            st.error(f"❌ Failed to upload '{file_name}': {e}")
+            continue
+
         books_col.insert_one({
             "title": row.get("title", ""),
             "author": row.get("author", ""),
@@ -613,6 +1105,8 @@ def bulk_upload_with_gridfs():
 
         count += 1
 
+    if count:
+        bump_catalog_version()
     st.success(f"✅ {count} book(s) uploaded successfully via GridFS!")
 
 def clear_collections():
@@ -625,12 +1119,76 @@ def clear_collections():
         if confirm == "CONFIRM":
             collections = db.list_collection_names()
             for coll_name in collections:
+                if coll_name == meta_col.name:
+                    continue  # keep the catalog version monotonic across clears
                 db[coll_name].delete_many({})
+            reset_sweep_state()
+            bump_catalog_version()
             st.success("✅ All collections cleared!")
             st.rerun()
         else:
             st.error("❌ You must type 'CONFIRM' exactly to clear the collections.")
 
+def storage_sweeper():
+    st.subheader("🧹 Storage Sweeper")
+    st.markdown("Cross-checks GridFS files and chunks against book records in small batches. "
+                "Progress is saved, so a sweep can be stopped and resumed.")
+
+    runner = get_sweeper_runner()
+    running = bool(runner["thread"] and runner["thread"].is_alive())
+    state = get_sweep_state()
+
+    st.write(f"**Phase:** {state.get('phase', 'files')} · **Cursor:** {state.get('cursor') or 'start'} · "
+             f"**Completed passes:** {state.get('passes', 0)}")
+    if state.get("completed_at"):
+        st.write(f"🕒 Last full pass: {state['completed_at'].strftime('%Y-%m-%d %H:%M')} UTC")
+    if running:
+        st.info("🔄 Background sweep in progress.")
+    if runner["error"]:
+        st.error(f"❌ Background sweep failed: {runner['error']}")
+
+    dry_run = st.checkbox("Dry run (report only)", value=True, key="sweep_dry_run")
+    batch_size = int(st.number_input("Batch size", min_value=10, max_value=1000, value=SWEEP_BATCH_SIZE, step=10, key="sweep_batch_size"))
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        if st.button("▶️ Run One Batch", key="sweep_run_batch", disabled=running):
+            run_sweep_batch(dry_run, batch_size)
+            rerun()
+    with col2:
+        if running:
+            if st.button("⏹️ Stop Sweep", key="sweep_stop"):
+                runner["stop"].set()
+                rerun()
+        elif st.button("🔁 Sweep in Background", key="sweep_start"):
+            start_background_sweep(dry_run, batch_size)
+            rerun()
+    with col3:
+        if st.button("♻️ Reset Progress", key="sweep_reset", disabled=running):
+            reset_sweep_state()
+            rerun()
+
+    stats = state.get("stats", {})
+    if stats:
+        st.write("### 📋 Issues Found (Current Pass)")
+        st.dataframe(pd.DataFrame([{"Issue": k, "Count": v} for k, v in stats.items()]))
+
+    if "last_stats" in state:
+        st.write("### 📋 Issues Found (Last Completed Pass)")
+        if state["last_stats"]:
+            st.dataframe(pd.DataFrame([{"Issue": k, "Count": v} for k, v in state["last_stats"].items()]))
+        else:
+            st.success("✅ No issues found.")
+
+    findings = state.get("findings", [])
+    if findings:
+        st.write("### 🔍 Recent Findings")
+        df = pd.DataFrame(findings).reindex(columns=["kind", "id", "detail", "reclaimed", "error", "at"])
+        st.dataframe(df)
+        failed = df["error"].notna().sum()
+        if failed:
+            st.error(f"❌ {failed} reclaim(s) failed; see the error column.")
+
 # --- Main ---
 def main():
     st.set_page_config("📚 DS Book Library")
@@ -663,6 +1221,7 @@ def main():
     "➕ Add Course",
     "🗑️ Delete Course", 
     "🗑️ Delete Book",
+    "🧹 Storage Sweeper",
     "⚠️ Clear Collections"
 ])
 
@@ -685,6 +1244,8 @@ def main():
             delete_course()
         elif admin_tab == "🗑️ Delete Book":
             delete_book()
+        elif admin_tab == "🧹 Storage Sweeper":
+            storage_sweeper()
     else:
         user_dashboard(user)
     